@@ -27,17 +27,336 @@ OTHER DEALINGS IN THE SOFTWARE.
 For more information, please refer to <http://unlicense.org/>
 """
 
-from typing import Optional, Tuple
+from typing import Any, Dict, List, NoReturn, Optional, Tuple
 
-from argparse import ArgumentParser
-from urllib.parse import urlparse
 from dataclasses import dataclass
-from sys import stderr, stdout
+from functools import lru_cache
+from sys import argv, platform, stderr, stdin, stdout
 from threading import Thread
-from hashlib import md5
+from hashlib import blake2b
+from errno import EAGAIN, EINTR, EWOULDBLOCK
+import selectors
+import ctypes
 import socket
+import os
+import struct
 
 from nacl.public import PrivateKey, PublicKey, Box
+from nacl.exceptions import CryptoError
+from nacl import _sodium  # type: ignore
+import nacl.bindings
+import nacl.utils
+
+# pynacl already does this on import, but libsodium only picks its cpu-specific
+# (sse/avx2) implementations once it has run, so make sure before anything is encrypted
+nacl.bindings.sodium_init()
+
+# pynacl's cffi bindings to libsodium, for calls its python wrappers cannot make in place
+ffi = _sodium.ffi
+lib = _sodium.lib
+
+# handshake frames are the prefix followed by the sender's public key
+_PREFIX: bytes = b"kampai_peer_establish:"
+_PLEN: int = len(_PREFIX)
+_FRAME_SIZE: int = _PLEN + PublicKey.SIZE
+
+# requested socket buffer sizes, the kernel clamps these to net.core.[rw]mem_max
+_SOCKET_BUFFER_SIZE: int = 4 * 1024 * 1024
+
+# microseconds to busy poll the device queue for before sleeping on an empty socket,
+# SO_BUSY_POLL is linux-only and not exposed by the socket module
+_BUSY_POLL_USEC: int = 50
+_SO_BUSY_POLL: int = getattr(socket, "SO_BUSY_POLL", 46)
+
+# seconds a joiner waits for the creator's answer before resending its key
+_HANDSHAKE_TIMEOUT: float = 5.0
+
+# maximum datagrams moved per sendmmsg(2)/recvmmsg(2) call, and the size of each slot
+_BATCH_SIZE: int = 64
+_DATAGRAM_SIZE: int = 4096
+
+# crypto_box_afternm(3) works on zero-padded buffers, the wire format is Box.encrypt's
+# nonce + mac + ciphertext, so the leading padding lands under the nonce
+_NONCE_SIZE: int = nacl.bindings.crypto_box_NONCEBYTES
+_ZERO_SIZE: int = nacl.bindings.crypto_box_ZEROBYTES
+_BOXZERO_SIZE: int = nacl.bindings.crypto_box_BOXZEROBYTES
+_PAD_OFFSET: int = _NONCE_SIZE - _BOXZERO_SIZE
+_MESSAGE_SIZE: int = _DATAGRAM_SIZE - _PAD_OFFSET - _ZERO_SIZE
+_BOXZEROS: bytes = bytes(_BOXZERO_SIZE)
+
+# both peers encrypt under the same shared key, so nonces are a random per-client prefix
+# followed by a message counter, unique without a getrandom(2) per message. received
+# counters are checked against a sliding window to drop replays
+_COUNTER: struct.Struct = struct.Struct(">Q")
+_NONCE_PREFIX_SIZE: int = _NONCE_SIZE - _COUNTER.size
+_REPLAY_WINDOW: int = 64
+
+
+class _iovec(ctypes.Structure):
+    _fields_ = [
+        ("iov_base", ctypes.c_void_p),
+        ("iov_len", ctypes.c_size_t),
+    ]
+
+
+class _msghdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(_iovec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+
+class _mmsghdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_hdr", _msghdr),
+        ("msg_len", ctypes.c_uint),
+    ]
+
+
+# sendmmsg(2) and recvmmsg(2) are linux-only, and not exposed by the socket module.
+# io_uring would cut syscalls further, but has no stdlib binding and kampai only depends
+# on pynacl; one epoll wakeup draining a whole recvmmsg(2) batch gets most of the way
+_libc: Optional[ctypes.CDLL] = None
+
+if platform.startswith("linux"):
+    try:
+        _libc = ctypes.CDLL(None, use_errno=True)
+        _libc.sendmmsg.argtypes = [
+            ctypes.c_int,
+            ctypes.c_void_p,
+            ctypes.c_uint,
+            ctypes.c_int,
+        ]
+        _libc.sendmmsg.restype = ctypes.c_int
+        _libc.recvmmsg.argtypes = [
+            ctypes.c_int,
+            ctypes.c_void_p,
+            ctypes.c_uint,
+            ctypes.c_int,
+            ctypes.c_void_p,
+        ]
+        _libc.recvmmsg.restype = ctypes.c_int
+
+    except (OSError, AttributeError):
+        _libc = None
+
+
+class _Batch:
+    """
+    Reusable mmsghdr, iovec and datagram buffer slots for sendmmsg(2)/recvmmsg(2), also
+    pinned for libsodium to encrypt into and decrypt from
+
+    size: int = _BATCH_SIZE
+        number of datagram slots
+    name: Optional[ctypes.Array] = None
+        packed sockaddr to send to, None for receiving batches
+    """
+
+    __slots__: Tuple[str, ...] = (
+        "size",
+        "buf",
+        "view",
+        "cbuf",
+        "cdata",
+        "iov",
+        "hdr",
+        "name",
+    )
+
+    size: int
+    buf: bytearray
+    view: memoryview
+    cbuf: ctypes.Array
+    cdata: Any
+    iov: ctypes.Array
+    hdr: ctypes.Array
+    name: Optional[ctypes.Array]
+
+    def __init__(
+        self, size: int = _BATCH_SIZE, name: Optional[ctypes.Array] = None
+    ) -> None:
+        self.size = size
+        self.buf = bytearray(size * _DATAGRAM_SIZE)
+        self.view = memoryview(self.buf)
+        self.cbuf = (ctypes.c_char * len(self.buf)).from_buffer(self.buf)
+        self.cdata = ffi.from_buffer("unsigned char[]", self.buf)
+        self.iov = (_iovec * size)()
+        self.hdr = (_mmsghdr * size)()
+        self.name = name
+
+        base: int = ctypes.addressof(self.cbuf)
+
+        for i in range(size):
+            self.iov[i].iov_base = base + (i * _DATAGRAM_SIZE)
+            self.iov[i].iov_len = _DATAGRAM_SIZE
+            self.hdr[i].msg_hdr.msg_iov = ctypes.pointer(self.iov[i])
+            self.hdr[i].msg_hdr.msg_iovlen = 1
+
+            if name is not None:
+                self.hdr[i].msg_hdr.msg_name = ctypes.addressof(name)
+                self.hdr[i].msg_hdr.msg_namelen = len(name)
+
+
+@lru_cache(maxsize=16)
+def _resolve(host: str, port: int, family: int = 0) -> Tuple[int, Tuple[Any, ...]]:
+    """
+    Resolve a host and port to the address family and socket address of the first
+    result getaddrinfo gives for a datagram socket, optionally of a given family.
+    """
+    results = socket.getaddrinfo(host, port, family, socket.SOCK_DGRAM)
+    return results[0][0], results[0][4]
+
+
+def _resolve_client(host: str, port: int) -> Tuple[int, Tuple[Any, ...]]:
+    """
+    Resolve the address the client binds to. IPv6 sockets are only dual-stack when bound
+    to the :: wildcard, so IPv6 is only used for a literal IPv6 address, and hostnames
+    resolve to IPv4.
+    """
+    try:
+        socket.inet_pton(socket.AF_INET6, host.partition("%")[0])
+
+    except OSError:
+        return _resolve(host, port, socket.AF_INET)
+
+    return _resolve(host, port, socket.AF_INET6)
+
+
+def _resolve_peer(host: str, port: int, family: int) -> Tuple[Any, ...]:
+    """
+    Resolve a peer to an address a socket of the given family can send to. IPv6 sockets
+    are dual-stack, so IPv4 peers are given to them as v4-mapped addresses.
+    """
+    if family == socket.AF_INET:
+        return _resolve(host, port, socket.AF_INET)[1]
+
+    peer_family, address = _resolve(host, port)
+
+    if peer_family == socket.AF_INET:
+        return ("::ffff:" + address[0], address[1], 0, 0)
+
+    return address
+
+
+def _sockaddr(family: int, address: Tuple[Any, ...]) -> ctypes.Array:
+    """
+    Pack a socket address into a struct sockaddr_in or sockaddr_in6.
+    """
+    if family == socket.AF_INET6:
+        host, port, flowinfo, scope_id = address
+        return ctypes.create_string_buffer(
+            struct.pack("=H", socket.AF_INET6)
+            + struct.pack("!HI", port, flowinfo)
+            + socket.inet_pton(socket.AF_INET6, host)
+            + struct.pack("=I", scope_id),
+            28,
+        )
+
+    host, port = address
+    return ctypes.create_string_buffer(
+        struct.pack("=H", socket.AF_INET)
+        + struct.pack("!H4s8x", port, socket.inet_aton(host)),
+        16,
+    )
+
+
+def _linux_sendmmsg(sock_fd: int, batch: _Batch, vlen: int) -> None:
+    """
+    Send the first vlen datagram slots of a batch, retrying on partial sends.
+    """
+    assert _libc is not None
+    sent: int = 0
+
+    while sent < vlen:
+        ret: int = _libc.sendmmsg(
+            sock_fd,
+            ctypes.addressof(batch.hdr) + (sent * ctypes.sizeof(_mmsghdr)),
+            vlen - sent,
+            0,
+        )
+
+        if ret < 0:
+            errno = ctypes.get_errno()
+            if errno == EINTR:
+                continue
+            raise OSError(errno, os.strerror(errno))
+
+        sent += ret
+
+
+def _linux_recvmmsg(sock_fd: int, batch: _Batch) -> int:
+    """
+    Receive as many pending datagrams as the batch can hold without blocking.
+    Returns the number of slots filled.
+    """
+    assert _libc is not None
+
+    while True:
+        ret: int = _libc.recvmmsg(
+            sock_fd, ctypes.addressof(batch.hdr), batch.size, socket.MSG_DONTWAIT, None
+        )
+
+        if ret >= 0:
+            return ret
+
+        errno = ctypes.get_errno()
+        if errno in (EAGAIN, EWOULDBLOCK):
+            return 0
+        if errno != EINTR:
+            raise OSError(errno, os.strerror(errno))
+
+
+def _tune_socket(sock: socket.socket) -> None:
+    """
+    Enlarge the socket buffers so bursts are not dropped, and busy poll on linux.
+    """
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, _SOCKET_BUFFER_SIZE)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, _SOCKET_BUFFER_SIZE)
+
+    if platform.startswith("linux"):
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, _SO_BUSY_POLL, _BUSY_POLL_USEC)
+
+        except OSError:  # raising it past net.core.busy_read needs CAP_NET_ADMIN
+            pass
+
+
+def _check_sodium() -> None:
+    """
+    Warn if libsodium is running without its AVX2 implementations on x86_64.
+    """
+    # os.uname() rather than the platform module, which is slow to import
+    arch: str = (
+        os.uname().machine
+        if hasattr(os, "uname")
+        else os.environ.get("PROCESSOR_ARCHITECTURE", "")  # windows
+    )
+
+    if arch.lower() not in ("x86_64", "amd64"):
+        return
+
+    try:
+        has_avx2: int = ctypes.CDLL(_sodium.__file__).sodium_runtime_has_avx2()
+
+    except (OSError, AttributeError):  # symbol not exported by this build
+        return
+
+    if not has_avx2:
+        stderr.write(
+            "kampai/prelude: libsodium is not using avx2, encryption will be slower\n"
+        )
+
+
+def _fingerprint(key: bytes) -> str:
+    """
+    Short, human-comparable fingerprint of a public key.
+    """
+    return blake2b(key, digest_size=4).hexdigest()[:7]
 
 
 @dataclass
@@ -49,19 +368,19 @@ class Behaviour:
         True if creator client
     target_host: Optional[str] = None
         ip address or hostname of peer, None for 'create' operation modes
-    target_port: int = 450000
+    target_port: int = 45000
         port of peer
     client_host: str = "127.0.0.1"
         ip address or hostname of client
-    client_port: int = 450000
+    client_port: int = 45000
         port of client
     """
 
     creator: bool = True
     target_host: Optional[str] = None
-    target_port: int = 450000
+    target_port: int = 45000
     client_host: str = "127.0.0.1"
-    client_port: int = 450000
+    client_port: int = 45000
 
 
 class Client:
@@ -70,9 +389,33 @@ class Client:
         "behaviour",
         "peer_host",
         "peer_port",
+        "_peer_address",
         "self_skey",
         "peer_pkey",
         "box",
+        "_self_pkey_bytes",
+        "_establish_frame",
+        "_shared_key",
+        "_nonce_prefix",
+        "_nonce_counter",
+        "_peer_nonce_prefix",
+        "_peer_counter",
+        "_peer_window",
+        "_prefix_warned",
+        "_key_c",
+        "_nonce_buf",
+        "_nonce_c",
+        "_pt_c",
+        "_rx_pt_buf",
+        "_rx_pt_mv",
+        "_rx_pt_c",
+        "_rx_buf",
+        "_rx_mv",
+        "_pt_buf",
+        "_tx_batch",
+        "_rx_batch",
+        "_selector",
+        "_stdin_buf",
     )
 
     sock: socket.socket
@@ -81,196 +424,575 @@ class Client:
 
     peer_host: str
     peer_port: int
+    _peer_address: Tuple[Any, ...]
 
     self_skey: PrivateKey
     peer_pkey: PublicKey
 
     box: Box
 
+    _self_pkey_bytes: bytes
+    _establish_frame: bytes
+
+    _shared_key: bytes
+
+    _nonce_prefix: bytes
+    _nonce_counter: int
+    _peer_nonce_prefix: Optional[bytes]
+    _peer_counter: int
+    _peer_window: int
+    _prefix_warned: bool
+
+    _key_c: Any
+    _nonce_buf: bytearray
+    _nonce_c: Any
+    _pt_c: Any
+    _rx_pt_buf: bytearray
+    _rx_pt_mv: memoryview
+    _rx_pt_c: Any
+    _rx_buf: bytearray
+    _rx_mv: memoryview
+    _pt_buf: bytearray
+
+    _tx_batch: _Batch
+    _rx_batch: _Batch
+
+    _selector: selectors.BaseSelector
+    _stdin_buf: bytes
+
     def __init__(self, behaviour: Behaviour) -> None:
         """
         Instantiate a new Kampai Client object.
         """
         self.behaviour = behaviour
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        family, address = _resolve_client(
+            self.behaviour.client_host, self.behaviour.client_port
+        )
+        self.sock = socket.socket(family, socket.SOCK_DGRAM)
+
+        if family == socket.AF_INET6:  # dual-stack, ipv4 peers arrive as v4-mapped
+            self.sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+
+        _tune_socket(self.sock)
+        self.sock.bind(address)
+
+        # reused by every recv_into, rather than a fresh 4096-byte bytes per datagram
+        self._rx_buf = bytearray(_DATAGRAM_SIZE)
+        self._rx_mv = memoryview(self._rx_buf)
 
-        self.sock.bind((self.behaviour.client_host, self.behaviour.client_port))
         self.self_skey = PrivateKey.generate()
 
-        stderr.write(
+        # serialised once, the handshake sends the same frame every time
+        self._self_pkey_bytes = bytes(self.self_skey.public_key)
+        self._establish_frame = _PREFIX + self._self_pkey_bytes
+
+        # prelude lines are collected and written together, once before the handshake
+        # blocks and once after it completes
+        log: List[str] = [
             "kampai/prelude: {} client started on {}:{}\n".format(
                 "creator" if self.behaviour.creator else "joiner",
                 self.behaviour.client_host,
                 self.behaviour.client_port,
             )
-        )
+        ]
 
         if not self.behaviour.creator:  # 'join' operation mode
-            # TODO: messages are sending, now why isnt this working?
-            establish = b"kampai_peer_establish:"
-            pubkey = bytes(self.self_skey.public_key)
-            self.sock.sendto(
-                establish + pubkey,
-                (self.behaviour.target_host, self.behaviour.target_port),
+            # joiners resend their key until the creator answers, creators block until
+            # a joiner's key arrives
+            assert self.behaviour.target_host is not None
+            target = _resolve_peer(
+                self.behaviour.target_host, self.behaviour.target_port, family
             )
-            stderr.write(
+
+            log.append(
                 "kampai/prelude: attempting to connect with peer {}:{}\n".format(
                     self.behaviour.target_host, self.behaviour.target_port
                 )
             )
-            # stderr.write(f"establish={establish.hex()}, pubkey={pubkey.hex()}\n\n")
 
-        waiting: bool = True
+        stderr.write("".join(log))
+        stderr.flush()
 
-        while waiting:
-            data, address = self.sock.recvfrom(4096)
-            sdata: bytes = data.strip()
+        if not self.behaviour.creator:
+            self.sock.settimeout(_HANDSHAKE_TIMEOUT)
+            self._send_establish(target)
 
-            if sdata.startswith(b"kampai_peer_establish:"):
-                key = sdata[-32:]
+        while True:
+            try:
+                length, address = self.sock.recvfrom_into(self._rx_buf)
 
-                self.peer_host = address[0]
-                self.peer_port = address[1]
+            except socket.timeout:
+                self._send_establish(target)
+                continue
 
-                self.peer_pkey = PublicKey(public_key=key)
-                self.box = Box(self.self_skey, self.peer_pkey)
+            view = self._rx_mv[:length]
 
-                stderr.write(
-                    "kampai/prelude: pubkey exchange (self={self}, peer={peer})\n".format(
-                        self=(md5(bytes(self.self_skey.public_key)).digest().hex())[:7],
-                        peer=(md5(key).digest().hex())[:7],
-                    )
-                )
+            # datagrams arrive whole, no stripping, which could also eat key bytes.
+            # anything but an exact frame is skipped before any key object is built
+            if length == _FRAME_SIZE and view[:_PLEN] == _PREFIX:
+                break
 
-                self.sock.sendto(
-                    b"kampai_peer_establish:" + bytes(self.self_skey.public_key),
-                    (self.peer_host, self.peer_port),
-                )
+        self.sock.settimeout(None)
 
-                stderr.write(
-                    f"kampai/prelude: kampai! peer is {self.peer_host}:{self.peer_port}\n"
-                )
-                waiting = False
+        key = bytes(view[_PLEN:])
+
+        self._peer_address = address
+        self.peer_host = address[0]
+        self.peer_port = address[1]
+
+        self.peer_pkey = PublicKey(public_key=key)
+        self.box = Box(self.self_skey, self.peer_pkey)
 
-        stderr.write("\n")
+        if self.behaviour.creator:  # the joiner already has our key once it hears back
+            self.sock.sendto(self._establish_frame, self._peer_address)
+
+        log = [
+            "kampai/prelude: pubkey exchange (self={self}, peer={peer})\n".format(
+                self=_fingerprint(self._self_pkey_bytes),
+                peer=_fingerprint(key),
+            ),
+            f"kampai/prelude: kampai! peer is {self.peer_host}:{self.peer_port}\n",
+        ]
+
+        # the curve25519 shared key is derived once, every message after this is only
+        # xsalsa20-poly1305 under it
+        self._shared_key = nacl.bindings.crypto_box_beforenm(
+            bytes(self.peer_pkey), bytes(self.self_skey)
+        )
+
+        self._nonce_prefix = nacl.utils.random(_NONCE_PREFIX_SIZE)
+        self._nonce_counter = 0
+        self._peer_nonce_prefix = None
+        self._peer_counter = -1
+        self._peer_window = 0
+        self._prefix_warned = False
+
+        # messages are padded and encrypted in place, into buffers allocated once and
+        # pinned for libsodium here rather than converted on every call
+        self._key_c = ffi.from_buffer("unsigned char[]", self._shared_key)
+        self._nonce_buf = bytearray(self._nonce_prefix + bytes(_COUNTER.size))
+        self._nonce_c = ffi.from_buffer("unsigned char[]", self._nonce_buf)
+        self._pt_buf = bytearray(_ZERO_SIZE + _MESSAGE_SIZE)
+        self._pt_c = ffi.from_buffer("unsigned char[]", self._pt_buf)
+        self._rx_pt_buf = bytearray(_DATAGRAM_SIZE)
+        self._rx_pt_mv = memoryview(self._rx_pt_buf)
+        self._rx_pt_c = ffi.from_buffer("unsigned char[]", self._rx_pt_buf)
+
+        # datagram slots are allocated once and reused for every batch. datagrams are
+        # encrypted into and decrypted in the slots even where there is no
+        # sendmmsg(2)/recvmmsg(2) to use them
+        self._tx_batch = _Batch(name=_sockaddr(family, self._peer_address))
+        self._rx_batch = _Batch()
+
+        self._selector = selectors.DefaultSelector()
+        self._stdin_buf = b""
+
+        log.append("\n")
+        stderr.write("".join(log))
+        stderr.flush()
+
+    def _send_establish(self, target: Tuple[Any, ...]) -> None:
+        try:
+            self.sock.sendto(self._establish_frame, target)
+
+        except OSError as exc:  # e.g. an ipv6 socket not bound to :: and an ipv4 peer
+            stderr.write(
+                f"kampai: could not send to peer {target[0]}:{target[1]}: "
+                f"{exc.strerror or exc}\n"
+            )
+            exit(-1)
+
+    def send(self, messages: List[bytes]) -> None:
+        """
+        Encrypt and send messages to the peer, in batches where sendmmsg(2) is available.
+        """
+        batch = self._tx_batch
+
+        if any(len(message) > _MESSAGE_SIZE for message in messages):
+            stderr.write(
+                f"kampai: messages longer than {_MESSAGE_SIZE} bytes are not sent\n"
+            )
+            messages = [message for message in messages if len(message) <= _MESSAGE_SIZE]
+
+        # bound once, instead of looked up for every message. encryption is inlined below
+        # rather than called through python helpers, leaving the libsodium call (which
+        # cffi makes without the gil) as the only call per message
+        _box = lib.crypto_box_afternm
+        _pack_into = _COUNTER.pack_into
+        _nonce = self._nonce_buf
+        _nonce_c = self._nonce_c
+        _key_c = self._key_c
+        _padded = self._pt_buf
+        _padded_c = self._pt_c
+        _iov = batch.iov
+        _view = batch.view
+        _cdata = batch.cdata
+        _fd = self.sock.fileno()
+        _sendto = self.sock.sendto
+        _peer = self._peer_address
+
+        # counters are reserved before anything is sent, so a failure part way through
+        # cannot lead to a nonce being used twice
+        counter: int = self._nonce_counter
+        self._nonce_counter += len(messages)
+
+        for start in range(0, len(messages), batch.size):
+            chunk = messages[start : start + batch.size]
+
+            for i, message in enumerate(chunk):
+                slot: int = i * _DATAGRAM_SIZE
+                clen: int = _ZERO_SIZE + len(message)
+                _pack_into(_nonce, _NONCE_PREFIX_SIZE, counter)
+                counter += 1
+
+                _padded[_ZERO_SIZE:clen] = message
+
+                if _box(_cdata + slot + _PAD_OFFSET, _padded_c, clen, _nonce_c, _key_c):
+                    raise CryptoError("Encryption failed")
+
+                # overwrites the zeroed crypto_box_BOXZEROBYTES
+                _view[slot : slot + _NONCE_SIZE] = _nonce
+                _iov[i].iov_len = _PAD_OFFSET + clen
+
+            if _libc is not None:
+                _linux_sendmmsg(_fd, batch, len(chunk))
+                continue
+
+            for i in range(len(chunk)):  # no sendmmsg(2), send one by one
+                slot = i * _DATAGRAM_SIZE
+                _sendto(_view[slot : slot + _iov[i].iov_len], _peer)
+
+    def receive(self) -> int:
+        """
+        Receive datagrams waiting on the socket into the receive batch, returning the
+        number of slots filled. Takes as many as the batch holds where recvmmsg(2) is
+        available, otherwise the one datagram select() reported.
+        """
+        batch = self._rx_batch
+
+        if _libc is None:
+            batch.hdr[0].msg_len = self.sock.recv_into(batch.view[:_DATAGRAM_SIZE])
+            return 1
+
+        return _linux_recvmmsg(self.sock.fileno(), batch)
 
     def get_input(self) -> None:
+        """
+        Read and send messages with input(), for platforms that cannot select on stdin.
+        """
+        _input = input
+        _send = self.send
+
         while True:
-            message = input("kampai> ")
+            try:
+                line: str = _input("kampai> ")
+            except EOFError:  # keep receiving after stdin runs out
+                return
+
+            _send([line.encode("utf-8")])
+
+    def _on_stdin(self) -> None:
+        chunk: bytes = os.read(stdin.fileno(), _DATAGRAM_SIZE)
+        encoding: str = stdin.encoding or "utf-8"
+
+        if chunk:
+            lines = (self._stdin_buf + chunk).split(b"\n")
+            self._stdin_buf = lines.pop()
+
+        else:  # eof, stop reading but keep receiving
+            self._selector.unregister(stdin)
+            lines = [self._stdin_buf] if self._stdin_buf else []  # unterminated last line
+            self._stdin_buf = b""
+
+        if lines:
+            self.send(
+                [
+                    line.rstrip(b"\r").decode(encoding, "replace").encode("utf-8")
+                    for line in lines
+                ]
+            )
+            stdout.write("kampai> ")
+            stdout.flush()
 
-            encrypted: bytes = self.box.encrypt(message.encode("utf-8"))
+    def _on_packet(self) -> None:
+        # decryption is a libsodium call that releases the gil, the python around it is
+        # what costs, so a batch is decrypted in one pass and printed with one write
+        # instead of handing each datagram to another process over a pipe
+        plaintexts: List[str] = []
 
-            # print(f"[sent] {encrypted.hex()}")
+        batch = self._rx_batch
 
-            self.sock.sendto(
-                encrypted,
-                (self.peer_host, self.peer_port),
-            )
+        _open = lib.crypto_box_open_afternm
+        _key_c = self._key_c
+        _out = self._rx_pt_mv
+        _out_c = self._rx_pt_c
+        _hdr = batch.hdr
+        _view = batch.view
+        _cdata = batch.cdata
+        _receive = self.receive
+        _append = plaintexts.append
+        _accept = self._accept_nonce
+
+        count: int = batch.size
+
+        while count == batch.size:
+            count = _receive()
+
+            for i in range(count):
+                slot: int = i * _DATAGRAM_SIZE
+                length: int = _hdr[i].msg_len
+
+                if length == _FRAME_SIZE and _view[slot : slot + _PLEN] == _PREFIX:
+                    # the joiner is resending its key, our answer to it was lost
+                    if self.behaviour.creator:
+                        self.sock.sendto(self._establish_frame, self._peer_address)
+                    continue
+
+                if length < _PAD_OFFSET + _ZERO_SIZE:  # shorter than nonce + mac
+                    continue
+
+                # the nonce is copied out so the crypto_box_BOXZEROBYTES of padding
+                # crypto_box_open_afternm(3) wants can be zeroed in under its tail
+                nonce: bytes = bytes(_view[slot : slot + _NONCE_SIZE])
+                _view[slot + _PAD_OFFSET : slot + _NONCE_SIZE] = _BOXZEROS
+                clen: int = length - _PAD_OFFSET
+
+                if _open(_out_c, _cdata + slot + _PAD_OFFSET, clen, nonce, _key_c):
+                    continue  # forged or corrupted
+
+                if not _accept(nonce):
+                    continue
+
+                try:
+                    _append(str(_out[_ZERO_SIZE:clen], "utf-8"))
+
+                except UnicodeDecodeError:
+                    pass
+
+        if plaintexts:
+            stdout.write("\r        \r" + "\n".join(plaintexts) + "\nkampai> ")
+            stdout.flush()
+
+    def _accept_nonce(self, nonce: bytes) -> bool:
+        """
+        Check the nonce of an authenticated datagram has not been seen before, and
+        remember it. Rejects our own nonces reflected back at us, and counters older
+        than the replay window.
+        """
+        prefix: bytes = nonce[:_NONCE_PREFIX_SIZE]
+
+        if prefix == self._nonce_prefix:
+            return False
+
+        if self._peer_nonce_prefix is None:
+            self._peer_nonce_prefix = prefix
+
+        elif prefix != self._peer_nonce_prefix:
+            if not self._prefix_warned:  # likely a peer from before counter nonces
+                stderr.write(
+                    "kampai: dropping messages with an unexpected nonce prefix, "
+                    "is the peer running a different version of kampai?\n"
+                )
+                self._prefix_warned = True
+            return False
+
+        counter: int = _COUNTER.unpack(nonce[_NONCE_PREFIX_SIZE:])[0]
+
+        if counter > self._peer_counter:
+            shift: int = counter - self._peer_counter
+
+            if shift >= _REPLAY_WINDOW:
+                self._peer_window = 1
+            else:
+                self._peer_window = ((self._peer_window << shift) | 1) & (
+                    (1 << _REPLAY_WINDOW) - 1
+                )
+
+            self._peer_counter = counter
+            return True
+
+        age: int = self._peer_counter - counter
+
+        if age >= _REPLAY_WINDOW or (self._peer_window >> age) & 1:
+            return False
+
+        self._peer_window |= 1 << age
+        return True
 
     def run(self) -> None:
-        input_mgr = Thread(target=self.get_input, daemon=True)
-        input_mgr.start()
+        self._selector.register(self.sock, selectors.EVENT_READ, self._on_packet)
 
-        while True:
-            ciphertext = self.sock.recv(4096)
+        if platform == "win32":  # select() on windows only works with sockets
+            Thread(target=self.get_input, daemon=True).start()
 
+        else:
             try:
-                # print(f"\n[recieved] {ciphertext.hex()}")
-                plaintext = self.box.decrypt(ciphertext).decode("utf-8")
+                self._selector.register(stdin, selectors.EVENT_READ, self._on_stdin)
 
-            except Exception as exc:
-                # stdout.write(f"\r        \r!!!!!!! {exc.__class__.__name__}: {exc}\nkampai> ")
-                pass
+            except OSError:  # epoll refuses regular files and /dev/null
+                Thread(target=self.get_input, daemon=True).start()
 
             else:
-                stdout.write(f"\r        \r{plaintext}\nkampai> ")
+                stdout.write("kampai> ")
+                stdout.flush()
 
+        _select = self._selector.select
 
-def main():
-    parser = ArgumentParser(
-        prog="kampai",
-        description="A method of peer-to-peer, end-to-end secure communications.",
-    )
+        while True:
+            for key, _ in _select():
+                key.data()
 
-    parser.add_argument(
-        "mode",
-        default="create",
-        const="create",
-        nargs="?",
-        choices=["create", "join"],
-        help="operation mode",
-    )
 
-    parser.add_argument(
-        "target_host",
-        type=str,
-        nargs="?",
-        default=None,
-        help="ip address or hostname of peers' client (only required for 'join' mode)",
-    )
+_USAGE: str = """usage: kampai [-h] [-ch CLIENT_HOST] [-cp CLIENT_PORT]
+              [{create,join}] [target_host] [target_port]
+"""
 
-    parser.add_argument(
-        "target_port",
-        type=int,
-        nargs="?",
-        default=45000,
-        help="specify peer port to use (defaults to 450000)",
-    )
+_HELP: str = """
+A method of peer-to-peer, end-to-end secure communications.
+
+positional arguments:
+  {create,join}         operation mode
+  target_host           ip address or hostname of peers' client (only required
+                        for 'join' mode)
+  target_port           specify peer port to use (defaults to 45000)
+
+options:
+  -h, --help            show this help message and exit
+  -ch CLIENT_HOST, --client_host CLIENT_HOST
+                        specify client ip address or hostname to use (defaults
+                        to '127.0.0.1')
+  -cp CLIENT_PORT, --client_port CLIENT_PORT
+                        specify client port to use (defaults to 45000)
+"""
 
-    parser.add_argument(
-        "-ch",
-        "--client_host",
-        type=str,
-        default="127.0.0.1",
-        help="specify client ip address or hostname to use (defaults to '127.0.0.1')",
-    )
 
-    parser.add_argument(
-        "-cp",
-        "--client_port",
-        type=int,
-        default=45000,
-        help="specify client port to use (defaults to 450000)",
-    )
+def _usage_error(message: str) -> NoReturn:
+    stderr.write(f"{_USAGE}kampai: error: {message}\n")
+    exit(2)
+
+
+def _port(value: str, name: str) -> int:
+    try:
+        port: int = int(value)
+
+    except ValueError:
+        _usage_error(f"argument {name}: invalid int value: '{value}'")
+
+    # udp ports are 16 bits, catch it here rather than as an OverflowError from sendto
+    if not 0 < port < 65536:
+        _usage_error(f"argument {name}: port must be between 1 and 65535, not {port}")
 
-    args = parser.parse_args()
+    return port
+
+
+def main():
+    # parsed by hand, argparse costs more to import than kampai takes to start
+    options: Dict[str, str] = {"client_host": "127.0.0.1", "client_port": "45000"}
+    flags: Dict[str, str] = {
+        "-ch": "client_host",
+        "--client_host": "client_host",
+        "-cp": "client_port",
+        "--client_port": "client_port",
+    }
+    long_flags: List[str] = ["--help"] + [name for name in flags if name[1] == "-"]
+    positionals: List[str] = []
+    args: List[str] = argv[1:]
+
+    while args:
+        arg: str = args.pop(0)
+        flag, equals, value = arg.partition("=")
+
+        if arg == "--":  # everything after is positional
+            positionals.extend(args)
+            break
+
+        if flag.startswith("--") and flag not in long_flags:
+            # like argparse, accept unambiguous prefixes of long options
+            matches: List[str] = [name for name in long_flags if name.startswith(flag)]
+            if len(matches) > 1:
+                _usage_error(f"ambiguous option: {flag} could match {', '.join(matches)}")
+            if matches:
+                flag = matches[0]
+                arg = flag + equals + value
+
+        if arg in ("-h", "--help"):
+            stdout.write(_USAGE + _HELP)
+            exit(0)
+
+        elif flag in flags:
+            if not equals:
+                if not args:
+                    _usage_error(f"argument {flag}: expected one argument")
+                value = args.pop(0)
+            options[flags[flag]] = value
+
+        elif arg.startswith("-") and arg != "-":
+            _usage_error(f"unrecognized arguments: {arg}")
+
+        else:
+            positionals.append(arg)
+
+    if len(positionals) > 3:
+        _usage_error(f"unrecognized arguments: {' '.join(positionals[3:])}")
+
+    mode: str = positionals[0] if len(positionals) > 0 else "create"
+    if mode not in ("create", "join"):
+        _usage_error(
+            f"argument mode: invalid choice: '{mode}' (choose from 'create', 'join')"
+        )
+
+    target_port: int = (
+        _port(positionals[2], "target_port") if len(positionals) > 2 else 45000
+    )
+    client_port: int = _port(options["client_port"], "-cp/--client_port")
 
     creator: bool = False
 
-    if args.mode == "create":
+    if mode == "create":
         creator = True
 
-    else:  # args.mode == "join"
-        if args.target_host is None:
+    else:  # mode == "join"
+        if len(positionals) < 2:
             stderr.write(
                 "kampai: operation mode 'join' requires the 'target_host' argument to be specified\n"
             )
             exit(-1)
 
-    target_host: str = args.target_host
-    if target_host is not None and "://" in target_host:
-        _url = urlparse(target_host)
-        target_host = socket.gethostbyname(_url.netloc)
-        stderr.write(
-            f"kampai/prelude: resolved target '{_url.geturl()}' to {target_host}\n"
-        )
-
-    client_host: str = args.client_host
+    client_host: str = options["client_host"]
     if "://" in client_host:
+        from urllib.parse import urlparse
+
         _url = urlparse(client_host)
-        client_host = socket.gethostbyname(_url.netloc)
+        client_host = _resolve_client(_url.hostname or _url.netloc, client_port)[1][0]
         stderr.write(
             f"kampai/prelude: resolved client '{_url.geturl()}' to {client_host}\n"
         )
 
+    # the target has to be reachable from the client's address family
+    client_family: int = _resolve_client(client_host, client_port)[0]
+
+    target_host: Optional[str] = positionals[1] if len(positionals) > 1 else None
+    if target_host is not None and "://" in target_host:
+        from urllib.parse import urlparse
+
+        _url = urlparse(target_host)
+        target_host = _resolve_peer(
+            _url.hostname or _url.netloc, target_port, client_family
+        )[0]
+        stderr.write(
+            f"kampai/prelude: resolved target '{_url.geturl()}' to {target_host}\n"
+        )
+
     behaviour: Behaviour = Behaviour(
         creator=creator,
         target_host=target_host,
-        target_port=args.target_port,
+        target_port=target_port,
         client_host=client_host,
-        client_port=args.client_port,
+        client_port=client_port,
     )
 
+    _check_sodium()
+
     client: Client = Client(behaviour=behaviour)
     client.run()
 